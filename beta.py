@@ -1,13 +1,14 @@
 import os
-import re
-import uuid
 import asyncio
 import shutil
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message
+from aiogram.types import Message, FSInputFile
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
@@ -18,113 +19,194 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")  # set via env var di hosting/VPS
 BASE_DIR = Path(__file__).parent.resolve()
 SESSIONS_DIR = BASE_DIR / "sessions"
 SESSIONS_DIR.mkdir(exist_ok=True)
+TRASH_DIR = BASE_DIR / "sessions_trash"  # folder sesi yang menunggu dihapus di background
+shutil.rmtree(TRASH_DIR, ignore_errors=True)  # sisa hapus yang terputus saat bot mati/restart
+TRASH_DIR.mkdir(exist_ok=True)
 
-ADMIN_IDS = [123456789]  # <-- Ganti dengan Telegram user_id kamu (int)
+ADMIN_IDS = frozenset({123456789})  # <-- Ganti dengan Telegram user_id kamu (int)
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB per tulis saat mengunduh file dari Telegram
+READ_CHUNK_SIZE = 1 << 20  # 1 MiB per baca saat parsing file .txt
 
 # ========= Helpers =========
 
-def format_number(raw: str, default_cc="+62", min_len=8, max_len=15):
-    raw = (raw or "").strip()
-    m = re.search(r"\+?\d{3,}", raw)
-    if not m:
+# Panjang tiap grup digit setelah kode negara: (min, max), max None = sisa digit.
+_CC_SPLITS = {
+    "+62": ((3, 4), (1, None)),
+    "+852": ((4, 4), (4, 4)),
+    "+60": ((2, 3), (1, None)),
+    "+65": ((4, 4), (4, 4)),
+    "+91": ((5, 5), (5, 5)),
+    "+92": ((3, 4), (1, None)),
+    "+880": ((3, 4), (1, None)),
+    "+966": ((3, 3), (1, None)),
+    "+971": ((2, 3), (1, None)),
+    "+63": ((3, 3), (1, None)),
+    "+234": ((3, 3), (1, None)),
+}
+
+def _find_token(raw):
+    # Hasil: (ada "+" di depan, deret digit pertama dengan panjang >= 3)
+    if isinstance(raw, bytes):
+        # Baris mentah dari file: nomor ASCII murni tidak perlu di-decode
+        s = raw.strip()
+        plus = s.startswith(b"+")
+        body = s[1:] if plus else s
+        if len(body) >= 3 and body.isdigit():
+            return plus, body.decode("ascii")
+        raw = raw.decode("utf-8", errors="ignore")
+
+    # Jalur cepat: baris berisi nomor saja (umumnya begitu)
+    s = raw.strip()
+    plus = s.startswith("+")
+    body = s[1:] if plus else s
+    if len(body) >= 3 and body.isdecimal():
+        return plus, body
+
+    # Cari deret digit pertama (>= 3), catat "+" tepat di depannya
+    n = len(raw)
+    i = 0
+    while i < n:
+        if raw[i].isdecimal():
+            j = i + 1
+            while j < n and raw[j].isdecimal():
+                j += 1
+            if j - i >= 3:
+                return i > 0 and raw[i - 1] == "+", raw[i:j]
+            i = j
+        i += 1
+    return None
+
+def _split_groups(code: str, rest: str, spec):
+    groups = [code]
+    pos = 0
+    need = sum(lo for lo, _ in spec)
+    for lo, hi in spec:
+        need -= lo
+        avail = len(rest) - pos - need
+        take = avail if hi is None else min(hi, avail)
+        if take < lo:
+            return None
+        groups.append(rest[pos:pos + take])
+        pos += take
+    return " ".join(groups)
+
+def _split_nanp(rest: str):
+    # +1 selalu 3-3-4 digit, cukup diiris langsung
+    if len(rest) < 10:
         return None
-    token = m.group(0)
+    return f"+1 {rest[:3]} {rest[3:6]} {rest[6:10]}"
 
-    if token.startswith("00"):
-        token = "+" + token[2:]
-    elif token.startswith("0"):
-        token = default_cc + token[1:]
-    elif not token.startswith("+"):
-        token = "+" + token
+_CC_FORMATTERS = {code: partial(_split_groups, code, spec=spec) for code, spec in _CC_SPLITS.items()}
+_CC_FORMATTERS["+1"] = _split_nanp
+# Panjang prefix yang dicoba saat lookup, terpanjang dulu
+_CC_LENGTHS = sorted({len(code) for code in _CC_FORMATTERS}, reverse=True)
 
-    digits = re.sub(r"\D", "", token)
-    if not (min_len <= len(digits) <= max_len):
+def format_number(raw, default_cc="+62", min_len=8, max_len=15):
+    found = _find_token(raw or "")
+    if found is None:
         return None
+    plus, digits = found
+
+    if plus or not digits.startswith("0"):
+        cc, skip = "+", 0
+    elif digits.startswith("00"):
+        cc, skip = "+", 2
+    else:
+        cc, skip = default_cc, 1
+
+    # Cek panjang dari hitungan saja, sebelum membuat string nomor baru
+    digit_count = len(cc) - 1 + len(digits) - skip
+    if not (min_len <= digit_count <= max_len):
+        return None
+    token = cc + digits[skip:]
 
-    patterns = {
-        "+62": r"(\+62)(\d{3,4})(\d+)",
-        "+852": r"(\+852)(\d{4})(\d{4})",
-        "+60": r"(\+60)(\d{2,3})(\d+)",
-        "+65": r"(\+65)(\d{4})(\d{4})",
-        "+91": r"(\+91)(\d{5})(\d{5})",
-        "+92": r"(\+92)(\d{3,4})(\d+)",
-        "+880": r"(\+880)(\d{3,4})(\d+)",
-        "+966": r"(\+966)(\d{3})(\d+)",
-        "+971": r"(\+971)(\d{2,3})(\d+)",
-        "+63": r"(\+63)(\d{3})(\d+)",
-        "+234": r"(\+234)(\d{3})(\d+)",
-        "+1": r"(\+1)(\d{3})(\d{3})(\d{4})",
-    }
-    for code, pattern in patterns.items():
-        if token.startswith(code):
-            m2 = re.match(pattern, token)
-            if m2:
-                return " ".join(m2.groups())
-            break
+    for size in _CC_LENGTHS:
+        formatter = _CC_FORMATTERS.get(token[:size])
+        if formatter is not None:
+            return formatter(token[size:]) or token
     return token
 
-def remove_duplicates(numbers: List[str]) -> List[str]:
-    seen, result = set(), []
-    for num in numbers:
-        if num not in seen:
-            seen.add(num)
-            result.append(num)
-    return result
-
 def list_txt_files(folder_path: Path) -> List[Path]:
     return sorted(Path(folder_path).glob("*.txt"))
 
 def write_vcard_batch(vcf_path: Path, contact_fullname_number_pairs: List[Tuple[str, str]]):
-    temp_path = str(vcf_path) + ".tmp"
-    with open(temp_path, "w", encoding="utf-8", newline="") as vcf:
-        for fullname, num in contact_fullname_number_pairs:
-            vcf.write("BEGIN:VCARD\r\n")
-            vcf.write("VERSION:3.0\r\n")
-            vcf.write(f"FN:{fullname}\r\n")
-            parts = fullname.split(" ", 1)
-            family = parts[1] if len(parts) > 1 else ""
-            given = parts[0]
-            vcf.write(f"N:{family};{given};;;\r\n")
-            vcf.write(f"UID:{uuid.uuid4()}\r\n")
-            vcf.write(f"TEL;TYPE=CELL:{num}\r\n")
-            vcf.write("END:VCARD\r\n\r\n")
-    os.replace(temp_path, vcf_path)
-
-def plan_outputs(src_folder: Path, base_file_name: str, per_file: int, output_dir: Path):
-    plan = []
-    conflicts = set()
-    total_contacts = 0
-    batch_idx_global = 0
+    # UID cukup unik: satu seed acak per file + nomor urut kontak
+    seed = os.urandom(12).hex()
+    buf = []
+    for i, (fullname, num) in enumerate(contact_fullname_number_pairs):
+        given, _, family = fullname.partition(" ")
+        buf.append(
+            f"BEGIN:VCARD\r\n"
+            f"VERSION:3.0\r\n"
+            f"FN:{fullname}\r\n"
+            f"N:{family};{given};;;\r\n"
+            f"UID:{seed}-{i:08x}\r\n"
+            f"TEL;TYPE=CELL:{num}\r\n"
+            f"END:VCARD\r\n\r\n"
+        )
 
-    txt_files = list_txt_files(src_folder)
-    if not txt_files:
-        raise ValueError("Folder tidak berisi file .txt.")
+    # Output ditulis ke folder sesi sendiri (tanpa pembaca lain), tidak perlu tmp + rename
+    with open(vcf_path, "wb") as vcf:
+        vcf.write("".join(buf).encode("utf-8"))
+
+def _iter_lines(src: Path):
+    # Baca biner per blok; potongan terakhir ditahan karena bisa terpotong
+    # (atau "\r" yang pasangan "\n"-nya ada di blok berikutnya)
+    tail = b""
+    with open(src, "rb") as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (tail + chunk).splitlines(keepends=True)
+            tail = lines.pop()
+            yield from lines
+    if tail:
+        yield tail
+
+def _parse_file(src: Path) -> Tuple[Dict[str, None], int]:
+    # dict menjaga urutan sisip sekaligus membuang duplikat dalam satu file
+    numbers = {}
+    invalid_count = 0
+    # Decode hanya untuk baris yang bukan nomor polos
+    for line in _iter_lines(src):
+        n = format_number(line)
+        if n:
+            numbers[n] = None
+        else:
+            invalid_count += 1
+    return numbers, invalid_count
+
+def plan_outputs(parsed_files: List[Tuple[Dict[str, None], int]], base_file_name: str, per_file: int, output_dir: Path):
+    conflicts = set()
 
-    all_numbers = []
+    # Gabungkan hasil per file (sudah bebas duplikat) sesuai urutan file
+    seen = {}
     invalid_count = 0
-    for src in txt_files:
-        with open(src, "r", encoding="utf-8", errors="ignore") as f:
-            for line in f:
-                n = format_number(line)
-                if n:
-                    all_numbers.append(n)
-                else:
-                    invalid_count += 1
-
-    all_numbers = remove_duplicates(all_numbers)
-    total_contacts = len(all_numbers)
+    for numbers, invalid in parsed_files:
+        seen.update(numbers)
+        invalid_count += invalid
+
+    total_contacts = len(seen)
     if total_contacts == 0:
         return [], 0, conflicts, invalid_count
 
-    for idx in range(0, len(all_numbers), per_file):
-        batch_idx_global += 1
+    # Nama file target (dan konflik) sudah pasti dari jumlah kontak
+    target_paths = []
+    for batch_idx_global in range(1, -(-total_contacts // per_file) + 1):
         target_name = f"{base_file_name} {batch_idx_global}.vcf"
         target_path = output_dir / target_name
         if target_path.exists():
             conflicts.add(str(target_path))
-        plan.append((all_numbers[idx:idx+per_file], target_path))
+        target_paths.append(target_path)
 
-    return plan, total_contacts, conflicts, invalid_count
+    # Isi batch diambil saat diiterasi, tanpa menyalin seluruh daftar nomor
+    def iter_batches():
+        numbers_iter = iter(seen)
+        for target_path in target_paths:
+            yield list(islice(numbers_iter, per_file)), target_path
+
+    return iter_batches(), total_contacts, conflicts, invalid_count
 
 # ========= FSM States =========
 class UploadStates(StatesGroup):
@@ -145,10 +227,43 @@ def session_paths(user_id: int) -> Tuple[Path, Path]:
     out_dir.mkdir(parents=True, exist_ok=True)
     return in_dir, out_dir
 
+def list_session_dirs() -> List[Path]:
+    # scandir sudah tahu tipe entri, tidak perlu stat per folder
+    with os.scandir(SESSIONS_DIR) as entries:
+        return [Path(entry.path) for entry in entries if entry.is_dir(follow_symlinks=False)]
+
+_bg_tasks = set()
+
+def _rmtree_bg(path: Path) -> bool:
+    # Pindahkan dulu (rename murah) supaya folder sesi bisa langsung dibuat ulang,
+    # lalu hapus isinya di thread tanpa menahan event loop
+    trash = TRASH_DIR / f"{path.name}.{os.urandom(4).hex()}"
+    try:
+        path.rename(trash)
+    except OSError:
+        if not path.exists():
+            return False
+        # Gagal dipindah: hapus langsung di tempat seperti sebelumnya
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+    task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, trash, ignore_errors=True))
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return True
+
 def clear_session(user_id: int):
     user_dir = SESSIONS_DIR / str(user_id)
     if user_dir.exists():
-        shutil.rmtree(user_dir, ignore_errors=True)
+        _rmtree_bg(user_dir)
+
+async def send_document_with_retry(msg: Message, fp: Path):
+    # Kena flood control Telegram: tunggu sesuai retry_after lalu kirim ulang
+    while True:
+        try:
+            await msg.answer_document(document=FSInputFile(fp), caption=fp.name)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
 
 # ========= Commands & Handlers =========
 
@@ -157,7 +272,6 @@ async def start_cmd(msg: Message, state: FSMContext):
     clear_session(msg.from_user.id)
     session_paths(msg.from_user.id)
     await state.set_state(UploadStates.collecting)
-    await state.update_data(uploaded_files=[])
     await msg.answer(
         "Halo! Kirimkan satu atau beberapa file .txt (satu nomor per baris).\n"
         "Jika sudah selesai, ketik /konfirmasi."
@@ -171,27 +285,28 @@ async def handle_document(msg: Message, state: FSMContext):
         return
 
     in_dir, _ = session_paths(msg.from_user.id)
-    dest = in_dir / doc.file_name
+    # Daftar upload dibaca dari folder sesi (glob "*.txt" peka huruf besar/kecil),
+    # jadi simpan selalu dengan akhiran ".txt" persis
+    dest_name = Path(doc.file_name)
+    if dest_name.suffix != ".txt":
+        dest_name = dest_name.with_suffix(".txt")
+    dest = in_dir / dest_name.name
 
     # Unduh ke server
     file = await bot.get_file(doc.file_id)
-    await bot.download_file(file.file_path, destination=dest)
-
-    # Simpan daftar file ke state
-    data = await state.get_data()
-    uploaded = data.get("uploaded_files", [])
-    uploaded.append(doc.file_name)
-    await state.update_data(uploaded_files=uploaded)
+    await bot.download_file(file.file_path, destination=dest, chunk_size=DOWNLOAD_CHUNK_SIZE)
 
+    # Cukup hitung (tanpa sort); folder in/ hanya berisi upload user ini
+    total_uploaded = sum(1 for _ in in_dir.glob("*.txt"))
     await msg.reply(
-        f"✅ {doc.file_name} tersimpan. Total: {len(uploaded)} file.\n"
+        f"✅ {doc.file_name} tersimpan. Total: {total_uploaded} file.\n"
         f"Ketik /konfirmasi jika sudah selesai."
     )
 
 @dp.message(Command("konfirmasi"))
 async def cmd_konfirmasi(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    uploaded = data.get("uploaded_files", [])
+    in_dir, _ = session_paths(msg.from_user.id)
+    uploaded = [p.name for p in list_txt_files(in_dir)]
     if not uploaded:
         await msg.reply("Belum ada file .txt yang diunggah. Unggah dulu lalu ketik /konfirmasi.")
         return
@@ -216,9 +331,8 @@ async def hapus_semua_cache_cmd(msg: Message):
         return
 
     count = 0
-    for folder in SESSIONS_DIR.glob("*"):
-        if folder.is_dir():
-            shutil.rmtree(folder, ignore_errors=True)
+    for folder in list_session_dirs():
+        if _rmtree_bg(folder):
             count += 1
 
     await msg.reply(f"🧹 Semua cache ({count} user) sudah dihapus dari server.")
@@ -262,8 +376,16 @@ async def process_inputs(msg: Message, state: FSMContext):
     status = await msg.reply("⏳ Memproses...")
 
     try:
+        txt_files = list_txt_files(in_dir)
+        if not txt_files:
+            raise ValueError("Folder tidak berisi file .txt.")
+
+        # Parsing tiap file di thread terpisah agar event loop tetap responsif
+        parsed_files = await asyncio.gather(
+            *(asyncio.to_thread(_parse_file, src) for src in txt_files)
+        )
         plan, total_contacts, conflicts, invalid_count = plan_outputs(
-            src_folder=in_dir,
+            parsed_files=parsed_files,
             base_file_name=base_file_name,
             per_file=per_file,
             output_dir=out_dir
@@ -275,19 +397,27 @@ async def process_inputs(msg: Message, state: FSMContext):
             await state.clear()
             return
 
-        # Tulis VCF
+        # Penomoran kontak tetap berurutan di sini, penulisan file di thread
         processed = 0
-        pad = len(str(total_contacts))
+        prefix = contact_name + " "
+        num_fmt = f"0{len(str(total_contacts))}d"
+        jobs = []
+        vcf_files = []
         for batch, target_path in plan:
             pairs = []
             for num in batch:
                 processed += 1
-                fullname = f"{contact_name} {str(processed).zfill(pad)}"
+                fullname = prefix + format(processed, num_fmt)
                 pairs.append((fullname, num))
-            write_vcard_batch(target_path, pairs)
+            jobs.append((target_path, pairs))
+            vcf_files.append(target_path)
+
+        # Tulis VCF
+        await asyncio.gather(
+            *(asyncio.to_thread(write_vcard_batch, target_path, pairs) for target_path, pairs in jobs)
+        )
 
         # Kirim hasil
-        vcf_files = sorted(out_dir.glob("*.vcf"))
         summary = (
             f"✅ Selesai!\n"
             f"• Total kontak valid: {total_contacts}\n"
@@ -295,8 +425,10 @@ async def process_inputs(msg: Message, state: FSMContext):
             f"• File VCF: {len(vcf_files)}"
         )
         await status.edit_text(summary)
+
+        # Kirim satu per satu agar urutan file di chat sesuai nomor batch
         for fp in vcf_files:
-            await msg.answer_document(document=fp.open("rb"), caption=fp.name)
+            await send_document_with_retry(msg, fp)
 
     except Exception as e:
         await status.edit_text(f"❌ Terjadi error: {e}")